@@ -4,6 +4,7 @@ import numpy as np
 import numpy.typing as npt
 from typing import List
 from scipy.special import spherical_jn as jn
+from scipy.optimize import brentq
 from paw import pawpotcar
 from vasp_constant import HARTREE
 
@@ -13,45 +14,27 @@ Mostly copied from GPAW
 
 def find_root_of_jn(L: int) -> List[float]:
     """
+    The zeros of j_l and j_(l+1) interlace, starting from the zeros n*pi of
+    j_0 each zero of j_l is bracketed by two consecutive zeros of j_(l-1).
+
     @in:
         - L: angular momentum number
     @out:
         - two roots of j_L(x) = 0
     """
-    THRESHOLD = 1E-10
-
-    nfound = 0
-    ret = [0.0, 0.0]
-
-    xinit = 1.0
-    for nfound in range(2):
-        # find the coarse interval of root
-        x1 = xinit
-        x2 = x1 + 1.0
-        fx1 = jn(L, x1)
-        fx2 = jn(L, x2)
-        while fx1 * fx2 > 0:
-            x2 += 1.0
-            fx2 = jn(L, x2)
-
-        # binary search
-        x1  = x2 - 1.0; fx1 = jn(L, x1)
-        while x2 - x1 > THRESHOLD:
-            mid = (x1 + x2) / 2
-            fmid = jn(L, mid)
-            if fx1 * fmid < 0:
-                x2 = mid
-                fx2 = fmid
-            else:
-                x1 = mid
-                fx1 = fmid
-
-        ret[nfound] = x1
-        xinit = x2
-    return ret
+    THRESHOLD = 1E-12
+
+    x = np.pi * np.arange(1, L + 3)             # first L+2 zeros of j_0
+    for l in range(1, L + 1):
+        x = [brentq(lambda t: jn(l, t), x1, x2, xtol=THRESHOLD)
+             for (x1, x2) in zip(x[:-1], x[1:])]
+    return list(x[:2])
 
 
 class Gaunt:
+    # G_LLL tables are shared by all the instances, keyed by lmax
+    gaunt_dict = {}
+
     def __init__(self):
         self.set_g()
         self.set_YL()
@@ -68,31 +51,50 @@ class Gaunt:
            L      L       -- L L  L
             1      2      L   1 2
 
-        Copied from gpaw/gaunt.py L13-45
+        Adapted from gpaw/gaunt.py L13-45
         '''
-        if not hasattr(self, 'gaunt_dict'):
-            self.gaunt_dict = {}
-        
-        if lmax in self.gaunt_dict:
-            return self.gaunt_dict[lmax]
+        if lmax in Gaunt.gaunt_dict:
+            return Gaunt.gaunt_dict[lmax]
 
         Lmax  = (  lmax + 1) ** 2
         L2max = (2*lmax + 1) ** 2
-        G_LLL = np.zeros((Lmax, L2max, L2max))
-        for L1 in range(Lmax):
-            for L2 in range(L2max):
-                for L in range(L2max):
-                    r = 0.0
-                    for c1, n1 in self.YL[L1]:
-                        for c2, n2 in self.YL[L2]:
-                            for c, n in self.YL[L]:
-                                nx = n1[0] + n2[0] + n[0]
-                                ny = n1[1] + n2[1] + n[1]
-                                nz = n1[2] + n2[2] + n[2]
-                                r += c * c1 * c2 * self.gam(nx, ny, nz)
-                    G_LLL[L1, L2, L] = r
-
-        self.gaunt_dict[lmax] = G_LLL
+
+        # Expand Y_L on the monomials x^nx y^ny z^nz: Y_L = \sum_a C_La n_a
+        n_a  = sorted({n for L in range(L2max) for c, n in self.YL[L]},
+                      key=lambda n: (sum(n), n))
+        C_La = np.zeros((L2max, len(n_a)))
+        for L in range(L2max):
+            for c, n in self.YL[L]:
+                C_La[L, n_a.index(n)] = c
+        # Y_L1 only needs the monomials up to degree lmax
+        n_a  = np.array(n_a, dtype=int)
+        a1   = np.sum(n_a, axis=1) <= lmax
+
+        # angular integrals of all the products of three monomials
+        n_abc = (n_a[a1, None, None, :]
+                 + n_a[None, :, None, :]
+                 + n_a[None, None, :, :])
+        h0, h1, h2 = (n_abc // 2).transpose(3, 0, 1, 2)
+        g = np.array(self.g)
+        gam_abc = np.where(np.all(n_abc % 2 == 0, axis=-1),
+                           2.0 * np.pi * g[h0] * g[h1] * g[h2] / g[1 + h0 + h1 + h2],
+                           0.0)
+
+        G_LLL = np.einsum('ia,jb,kc,abc->ijk',
+                          C_La[:Lmax, a1], C_La, C_La, gam_abc,
+                          optimize=True)
+
+        # Only l1 + l2 + l even and |l1 - l2| <= l <= l1 + l2 couple, zero out
+        # the round-off in all the other G_LLL.
+        l_L = np.floor(np.sqrt(np.arange(L2max))).astype(int)
+        l1  = l_L[:Lmax, None, None]
+        l2  = l_L[None, :, None]
+        l   = l_L[None, None, :]
+        G_LLL[((l1 + l2 + l) % 2 == 1)
+              | (l < np.abs(l1 - l2))
+              | (l > l1 + l2)] = 0.0
+
+        Gaunt.gaunt_dict[lmax] = G_LLL
         return G_LLL
 
 
@@ -425,8 +427,7 @@ class PAWCoulombCorrection:
         self.calculate_integral_potentials()
         self.calculate_Delta_lq()
 
-        _np = self.ni * (self.ni + 1) // 2
-        self.calculate_T_Lqp(self.lcut, _np, self.nj, self.jlL_i)
+        self.calculate_T_Lqp(self.lcut, self._np, self.nj, self.jlL_i)
         self.calculate_coulomb_corrections(
                 self.wn_lqg, self.wnt_lqg, self.wg_lg, self.wnc_g, self.wmct_g)
         return
@@ -458,6 +459,7 @@ class PAWCoulombCorrection:
         self.ni = len(jlL_i)
         self.nj = len(self.l_j)
         self.nq = self.nj * (self.nj + 1) // 2
+        self._np = self.ni * (self.ni + 1) // 2                         # number of packed (i1, i2) pairs
         return
 
 
@@ -465,7 +467,7 @@ class PAWCoulombCorrection:
         self.symbol  = pot.symbol
         self.valence = pot.zval
         self.Z       = pot.Z
-        self.valence = pot.Z - pot.zval
+        self.core    = pot.Z - pot.zval
         return
 
 
@@ -473,6 +475,14 @@ class PAWCoulombCorrection:
         self.r_g   = pot.rgrid.copy()
         self.dr_g  = pot.rad_simp_w.copy()
         self.rdr_g = self.r_g * self.dr_g
+
+        # r^l for l = 0 .. 2*lcut+2 by cumulative products, shared by the
+        # Poisson solver and the radial moments
+        nl = 2 * self.lcut + 3
+        self.r_lg = np.cumprod(
+                np.vstack([np.ones_like(self.r_g),
+                           np.broadcast_to(self.r_g, (nl - 1, self.r_g.size))]),
+                axis=0)
         return
 
 
@@ -481,22 +491,41 @@ class PAWCoulombCorrection:
         #          [4.493409457909095, 7.7252518369375],
         #          [5.76345919689455,  9.095011330476355]]
 
+        l_l  = np.arange(lmax + 1)
+        q1_l, q2_l = np.array([find_root_of_jn(l) for l in l_l]).T / rc
+        # q*rc are roots of j_l, where j_l'(q*rc) = -j_{l+1}(q*rc)
+        self.rc      = rc
+        self.q_xl    = np.array([q1_l, q2_l])
+        self.alpha_l = -q1_l / q2_l * jn(l_l+1, q1_l*rc) / jn(l_l+1, q2_l*rc)
+        self.gnorm_l = np.ones(lmax + 1)
+
+        # g_l vanishes beyond rc, only evaluate it inside the compensation radius
         g_lg = np.zeros((lmax+1, r_g.size))
-        for l in range(lmax + 1):
-            q1, q2 = (x0 / rc for x0 in find_root_of_jn(l))
-            alpha  = -q1 / q2 * jn(l, q1*rc, True) / jn(l, q2 * rc, True)
-            g_lg[l] = jn(l, q1 * r_g) + alpha * jn(l, q2 * r_g)
-            pass
-
-        g_lg[:, gcut:] = 0.0
-        
-        for l in range(lmax + 1):
-            g_lg[l,:] /= self.rgd_integrate(g_lg[l,:], l) / (4 * np.pi)
-        
+        r_g  = r_g[:gcut]
+        g_lg[:, :gcut] = self.shape_function(l_l[:, None], r_g)
+
+        # normalize all the l channels at once, \int dr r^(l+2) g_l(r) = 1
+        w_lg = self.r_lg[2:lmax+3, 1:gcut] * self.dr_g[1:gcut]
+        self.gnorm_l = 1.0 / np.einsum('lg,lg->l', g_lg[:, 1:gcut], w_lg)
+        g_lg *= self.gnorm_l[:, None]
+
         self.g_lg = g_lg
         return
 
 
+    def shape_function(self, l, r):
+        '''
+        Normalized compensation shape function g_l(r), zero beyond rc. "l" and
+        "r" broadcast against each other, e.g. l[:, None] and r give the table
+        of all the l channels on the grid.
+        '''
+        l, r = np.broadcast_arrays(l, np.asarray(r, dtype=float))
+        # both roots stacked on a leading axis, one spherical_jn call
+        j_xg = jn(l, self.q_xl[:, l] * r)
+        g = (j_xg[0] + self.alpha_l[l] * j_xg[1]) * self.gnorm_l[l]
+        return np.where(r < self.rc, g, 0.0)
+
+
     def build_paw_functions(self, pot: pawpotcar):
         self.nc_g   = pot.aechg.copy()
         self.nct_g  = pot.pschg.copy()
@@ -511,25 +540,29 @@ class PAWCoulombCorrection:
 
 
     @staticmethod
-    def hartree(l: int, nrdr: npt.NDArray, r: npt.NDArray):
-        M = nrdr.size
-        vr = np.zeros(M, dtype=float)
+    def hartree(l: int, nrdr: npt.NDArray, r: npt.NDArray, rl=None):
+        '''
+        Radial Poisson solver, the radial grid runs along the last axis of
+        "nrdr" so that a stack of densities can be solved at once. "l" may
+        also be an array broadcastable to nrdr[..., :1], one l for each row.
+        "rl" is r^l on the same grid if already tabulated.
+        '''
+        vr = np.zeros(nrdr.shape, dtype=float)
 
-        rl   = r[1:]**l
+        rl   = r[1:]**l if rl is None else rl[..., 1:]
         rlp1 = rl * r[1:]
-        dp   = nrdr[1:] / rl
-        dq   = nrdr[1:] * rlp1
-        dpfl = np.flip(dp)
-        dqfl = np.flip(dq)
+        dp   = nrdr[..., 1:] / rl
+        dq   = nrdr[..., 1:] * rlp1
 
-        p = np.flip(np.r_[0, np.cumsum(dpfl)])    # prepend 0 to cumsum
-        q = np.flip(np.r_[0, np.cumsum(dqfl)])
-
-        vr[1:] = (p[1:] + 0.5 * dp) * rlp1 - (q[1:] + 0.5 * dq) / rl
-        vr[0] = 0.0
+        # outward sums as reversed cumsum on views, no flipped copies
+        p = np.cumsum(dp[..., ::-1], axis=-1)[..., ::-1]
+        q = np.cumsum(dq[..., ::-1], axis=-1)[..., ::-1]
+        q0 = q[..., :1].copy()                  # total sum
+        p -= 0.5 * dp
+        q -= 0.5 * dq
 
         f = 4.0 * np.pi / (2 * l + 1)
-        vr[1:] = f * (vr[1:] + q[0] / rl)
+        vr[..., 1:] = f * (p * rlp1 + (q0 - q) / rl)
         return vr
 
 
@@ -537,20 +570,14 @@ class PAWCoulombCorrection:
         # lmax  = self.lmax
         gcut2 = self.gcut
         # g_lg  = self.g_lg
-        nq    = self.nq
 
         phi_g  = self.phi_g[:,:gcut2]
         phit_g = self.phit_g[:,:gcut2]
 
-        n_qg  = np.zeros((nq, gcut2))
-        nt_qg = np.zeros((nq, gcut2))
-        for (q, (j1, j2)) in enumerate([(j1, j2) for j1 in range(self.nj)
-                                                 for j2 in range(j1,self.nj)]):
-            n_qg[q,:]  = phi_g[j1,:]  * phi_g[j2,:]                     #  phi_i1^a *  phi_i2^a
-            nt_qg[q,:] = phit_g[j1,:] * phit_g[j2,:]                    # ~phi_i1^a * ~phi_i2^a
-
-        self.n_qg  = n_qg
-        self.nt_qg = nt_qg
+        # the pair densities are symmetric in (j1, j2), only j1 <= j2 is kept
+        j1, j2 = np.triu_indices(self.nj)
+        self.n_qg  = phi_g[j1,:]  * phi_g[j2,:]                         #  phi_i1^a *  phi_i2^a
+        self.nt_qg = phit_g[j1,:] * phit_g[j2,:]                        # ~phi_i1^a * ~phi_i2^a
 
         ## Delta0 is an constant for each atom
         self.Delta0 = np.dot(self.nc_g[:gcut2] - self.nct_g[:gcut2],    # 
@@ -559,25 +586,25 @@ class PAWCoulombCorrection:
 
 
     def poisson(self, n_g, l=0, *, s:slice=slice(None)):
-        n_g    = n_g[s].copy()
-        nrdr_g = n_g[s] * self.rdr_g[s]
-        return PAWCoulombCorrection.hartree(l, nrdr_g, self.r_g[s])
+        nrdr_g = n_g[..., s] * self.rdr_g[s]
+        rl_g   = self.r_lg[np.ravel(l), s]                              # one row per l
+        return PAWCoulombCorrection.hartree(l, nrdr_g, self.r_g[s], rl_g)
 
 
     def calculate_integral_potentials(self):
         def H(n_g, l, *, s:slice=slice(None)):
-            return self.poisson(n_g[s], l, s=s) * self.r_g[s] * self.dr_g[s]
+            return self.poisson(n_g, l, s=s) * self.rdr_g[s]
 
         gcut2 = self.gcut
 
-        wg_lg   = [H(self.g_lg[l,:], l, s=slice(None,gcut2))
-                   for l in range(self.lmax + 1)]                       # ((~g_l^a)) in Eq (47)
-        wn_lqg  = [np.array([H(self.n_qg[q,:], l, s=slice(None,gcut2))
-                             for q in range(self.nq)])
-                   for l in range(2*self.lcut + 1)]                     # ( phi_i1^a *  phi_i2^a  |   phi_i3^a *  phi_i4^a * r^l) in Eq (47)
-        wnt_lqg = [np.array([H(self.nt_qg[q,:], l, s=slice(None,gcut2))
-                             for q in range(self.nq)])
-                   for l in range(2*self.lcut + 1)]                     # (~phi_i1^a * ~phi_i2^a  |  ~phi_i3^a * ~phi_i4^a * r^l) in Eq (47)
+        l_l     = np.arange(self.lmax + 1)
+        wg_lg   = H(self.g_lg, l_l[:, None], s=slice(None,gcut2))       # ((~g_l^a)) in Eq (47)
+        # AE and PS pair densities share the same kernel, solve them together
+        n_xqg   = np.array([self.n_qg, self.nt_qg])
+        w_lxqg  = [H(n_xqg, l, s=slice(None,gcut2))
+                   for l in range(2*self.lcut + 1)]
+        wn_lqg  = [w_xqg[0] for w_xqg in w_lxqg]                        # ( phi_i1^a *  phi_i2^a  |   phi_i3^a *  phi_i4^a * r^l) in Eq (47)
+        wnt_lqg = [w_xqg[1] for w_xqg in w_lxqg]                        # (~phi_i1^a * ~phi_i2^a  |  ~phi_i3^a * ~phi_i4^a * r^l) in Eq (47)
 
         wnc_g  = H(self.nc_g[:],  l=0, s=slice(None,gcut2))             # (( n_c^a))
         wnct_g = H(self.nct_g[:], l=0, s=slice(None,gcut2))             # ((~n_c^a))
@@ -604,41 +631,32 @@ class PAWCoulombCorrection:
         LGcut = G_LLL.shape[2]
         T_Lqp = np.zeros((Lcut, self.nq, _np))
 
-        p  = 0
-        i1 = 0
-
-        for j1, l1, L1 in jlL_i:
-            for j2, l2, L2 in jlL_i[i1:]:
-                if j1 < j2:
-                    q = j2 + j1 * nj - j1 * (j1 + 1) // 2
-                else:
-                    q = j1 + j2 * nj - j2 * (j2 + 1) // 2
-                T_Lqp[:LGcut, q, p] = G_LLL[L1, L2, :]
-                p += 1
-            i1 += 1
+        j_i, _, L_i = np.array(jlL_i).T
+        i1, i2 = np.triu_indices(len(jlL_i))                            # p runs over i1 <= i2
+        j1 = np.minimum(j_i[i1], j_i[i2])
+        j2 = np.maximum(j_i[i1], j_i[i2])
+        q_p = j2 + j1 * nj - j1 * (j1 + 1) // 2                         # q of the (j1, j2) pair of each p
+        T_Lqp[:LGcut, q_p, np.arange(_np)] = G_LLL[L_i[i1], L_i[i2], :].T
         self.T_Lqp = T_Lqp
         return
 
 
     def calculate_Delta_lq(self):
         gcut2 = self.gcut
-        r_g   = self.r_g[:gcut2]
         dr_g  = self.dr_g[:gcut2]
         n_qg  = self.n_qg
         nt_qg = self.nt_qg
 
-        Delta_lq = np.zeros((self.lmax + 1, self.nq))
-        for l in range(self.lmax + 1):
-            Delta_lq[l,:] = (n_qg - nt_qg) @ (r_g**(l+2) * dr_g)        # \sum dr * r^l * ( phi_i1 *  phi_i2 - ~phi_i1 * ~phi_i2)
+        w_lg  = self.r_lg[2:self.lmax+3, :gcut2] * dr_g                 # r^(l+2) dr for all l
+        Delta_lq = w_lg @ (n_qg - nt_qg).T                              # \sum dr * r^l * ( phi_i1 *  phi_i2 - ~phi_i1 * ~phi_i2)
         self.Delta_lq = Delta_lq                                        # Delta_Li1i2^a in Eq (41b) (without Y_L(r) part)
         return
 
 
     def calculate_coulomb_corrections(self, wn_lqg, wnt_lqg, wg_lg, wnc_g, wmct_g):
         gcut2 = self.gcut
-        _np   = self.ni * (self.ni + 1) // 2
         mct_g = self.nct_g[:gcut2] + self.Delta0 * self.g_lg[0, :gcut2] # ~n_c^a + Delta^a * ~g_00^a
-        rdr_g = self.r_g[:gcut2] * self.dr_g[:gcut2]
+        rdr_g = self.rdr_g[:gcut2]
 
         A_q  = 0.5 * (wn_lqg[0] @ self.nc_g[:gcut2] + self.n_qg @ wnc_g)        # (phi_i1 * phi_i2 | n_c^a) + 
         A_q -= np.sqrt(4 * np.pi) * self.Z * (self.n_qg @ rdr_g)
@@ -646,27 +664,28 @@ class PAWCoulombCorrection:
         A_q -= 0.5 * (mct_g @ wg_lg[0] + self.g_lg[0,:gcut2] @ wmct_g) * self.Delta_lq[0,:]
         M_p  = A_q @ self.T_Lqp[0]                                      # DeltaC_i1i2^a in Eq (46)
 
-        A_lqq = []
-        for l in range(2 * self.lcut + 1):
-            A_qq  = 0.5 * self.n_qg @ wn_lqg[l].T
-            A_qq -= 0.5 * self.nt_qg @ wnt_lqg[l].T                     # 1/2 * [ ( | ) - ( ~ | ~ ) ] in Eq (47)
-
-            if l <= self.lmax:
-                A_qq -= 0.5 * np.outer(self.Delta_lq[l,:],              # 1/2 * Delta_Li1i2^a (~phi_i1^a * ~phi_i2^a | ~g_l^a)
-                                       wnt_lqg[l] @ self.g_lg[l,:gcut2])
-                A_qq -= 0.5 * np.outer(self.nt_qg @ wg_lg[l],           # 1/2 * Delta_Li3i4^a (~phi_i3^a * ~phi_i4^a | ~g_l^a)
-                                       self.Delta_lq[l,:])
-                A_qq -= 0.5 * ((self.g_lg[l,:gcut2] @ wg_lg[l])         # Delta_Li1i2^a * ((~g_l^a)) * Delta_Li3i4
-                               * np.outer(self.Delta_lq[l], self.Delta_lq[l]))
-            A_lqq.append(A_qq)
-            pass
-
-        M_pp = np.zeros((_np, _np))                                     # DeltaC_i1i2i3i4^a in Eq (47)
-        L = 0
-        for l in range(2 * self.lcut + 1):
-            for m in range(2 * l + 1):
-                M_pp += self.T_Lqp[L].T @ A_lqq[l] @ self.T_Lqp[L]      # Multiple all the quantities with the angular term
-                L += 1
+        lmax1   = self.lmax + 1
+        wn_lqg  = np.asarray(wn_lqg)
+        wnt_lqg = np.asarray(wnt_lqg)
+        wntg_lq = np.einsum('lqg,lg->lq', wnt_lqg[:lmax1],              # (~phi_i1^a * ~phi_i2^a | ~g_l^a)
+                            self.g_lg[:, :gcut2])
+        ntwg_lq = wg_lg @ self.nt_qg.T                                  # (~g_l^a | ~phi_i3^a * ~phi_i4^a)
+        gwg_l   = np.einsum('lg,lg->l', self.g_lg[:, :gcut2], wg_lg)    # ((~g_l^a))
+
+        A_lqq  = 0.5 * self.n_qg  @ wn_lqg.transpose(0, 2, 1)           # all l in one batched product
+        A_lqq -= 0.5 * self.nt_qg @ wnt_lqg.transpose(0, 2, 1)          # 1/2 * [ ( | ) - ( ~ | ~ ) ] in Eq (47)
+
+        # the compensation-charge terms of all l <= lmax as batched outer products
+        Delta_lq = self.Delta_lq
+        A_lqq[:lmax1] -= 0.5 * np.einsum('lq,lp->lqp', Delta_lq, wntg_lq)   # 1/2 * Delta_Li1i2^a (~phi_i1^a * ~phi_i2^a | ~g_l^a)
+        A_lqq[:lmax1] -= 0.5 * np.einsum('lq,lp->lqp', ntwg_lq, Delta_lq)   # 1/2 * Delta_Li3i4^a (~phi_i3^a * ~phi_i4^a | ~g_l^a)
+        A_lqq[:lmax1] -= 0.5 * np.einsum('l,lq,lp->lqp',                    # Delta_Li1i2^a * ((~g_l^a)) * Delta_Li3i4
+                                         gwg_l, Delta_lq, Delta_lq)
+
+        l_L  = np.repeat(np.arange(2 * self.lcut + 1),                  # l of each L = (l, m)
+                         2 * np.arange(2 * self.lcut + 1) + 1)
+        M_pp = np.einsum('Lqp,Lqr,Lrs->ps', self.T_Lqp, A_lqq[l_L],     # DeltaC_i1i2i3i4^a in Eq (47)
+                         self.T_Lqp, optimize=True)                     # Multiple all the quantities with the angular term
 
         self.M_p  = M_p
         self.M_pp = M_pp
@@ -683,18 +702,14 @@ class PAWCoulombCorrection:
 
 
 def pack(A) -> npt.NDArray:
-    ni = A.shape[0]
-    N  = ni * (ni + 1) // 2
-    B  = np.zeros(N, dtype=A.dtype)
-
-    k = 0
-    for i in range(ni):
-        B[k] = A[i,i]
-        k += 1
-        for j in range(i+1, ni):
-            B[k] = A[i,j] + A[j,i]
-            k += 1
-    return B
+    '''
+    Pack the last two axes of A into the row-major upper triangle, the lower
+    triangle is folded onto it.
+    '''
+    ni   = A.shape[-1]
+    i, j = np.triu_indices(ni)
+
+    return np.where(i == j, A[..., i, j], A[..., i, j] + A[..., j, i])
 
 
 if '__main__' == __name__:
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import numpy as np
-from numpy.fft import fftn
+from collections import OrderedDict
+from scipy.fft import fftn, rfftn
 from ase.io.vasp import read_vasp
 
 from vasp_constant import (
@@ -16,20 +17,72 @@ from coulomb_correction import (
 
 
 class PWCoulombIntegral(vaspwfc):
-    def __init__(self, **kwargs):
+    def __init__(self, wfc_cache_size: int=64, **kwargs):
+        '''
+        @in:
+            - wfc_cache_size: at most this many real space wavefunctions are
+                              kept, the least recently used is dropped first.
+                              0 disables the cache, None leaves it unbounded.
+        '''
+        assert wfc_cache_size is None or wfc_cache_size >= 0, \
+            'wfc_cache_size must be None or a non-negative integer!'
         super().__init__(**kwargs)
+        # real space pseudo-wavefunctions, keyed by (ispin, ikpt, iband)
+        self._wfc_r_cache = OrderedDict()
+        self._wfc_cache_size = wfc_cache_size
         pass
 
-    def density_matrix(self, m: int, n: int):
+    def _get_wfc_r(self, iband: int, ispin: int=1, ikpt: int=1):
+        '''
+        Real space pseudo-wavefunction of the state "iband" at Gamma point.
+        The same state enters many density matrices, the inverse FFT is
+        therefore only done once for each band as long as it stays in the
+        cache.
+        '''
+        key = (ispin, ikpt, iband)
+        if key in self._wfc_r_cache:
+            self._wfc_r_cache.move_to_end(key)
+            return self._wfc_r_cache[key]
+
+        wfc = self.wfc_r(
+                ispin=ispin, ikpt=ikpt, iband=iband,
+                gvec=self.gvec_fft if ikpt == 1 else None,
+                ngrid=self._ngrid, norm=False
+                )
+        self._wfc_r_cache[key] = wfc
+        if self._wfc_cache_size is not None:
+            while len(self._wfc_r_cache) > self._wfc_cache_size:
+                self._wfc_r_cache.popitem(last=False)
+        return wfc
+
+    @property
+    def gvec_fft(self):
+        '''
+        G-vectors of the Gamma point wrapped onto the FFT grid. They are the
+        same for every band, wfc_r would otherwise regenerate them each call.
+        '''
+        if not hasattr(self, '_gvec_fft'):
+            self._gvec_fft = self.gvectors(ikpt=1) % self._ngrid[np.newaxis, :]
+        return self._gvec_fft
+
+    def density_matrix(self, m: int, n: int, half: bool=False):
         '''
               ⌠     *           iGr
         Sₘₙ = ⎮ dr ϕₘ(r) ϕₙ(r) e
               ⌡
+
+        @in:
+            - half: Sₘₙ(r) is real for Gamma-only WAVECAR, only return the
+                    non-negative half of the last axis from a real-to-complex FFT
         '''
-        um = self.wfc_r(ispin=1, ikpt=1, iband=m, ngrid=self._ngrid, norm=False)
-        un = self.wfc_r(ispin=1, ikpt=1, iband=n, ngrid=self._ngrid, norm=False)
+        um = self._get_wfc_r(m)
+        un = self._get_wfc_r(n)
         Smn = um.conj() * un
-        return fftn(Smn)
+        # the FFT threads follow the omp_num_threads setting of vaspwfc
+        workers = self._omp_num_threads
+        if half:
+            return rfftn(Smn.real, workers=workers)
+        return fftn(Smn, workers=workers)
 
     @property
     def gvectors_cart(self):
@@ -54,6 +107,40 @@ class PWCoulombIntegral(vaspwfc):
             self._gvectors_cart = kgrid @ self._Bcell
         return self._gvectors_cart
 
+    @property
+    def inv_Gsqr(self):
+        '''
+        1 / |G|^2 on the FFT grid, the G = 0 term is set to 0
+
+        @out:
+            - 1 / |G|^2 in Angstrom^2
+        '''
+        if not hasattr(self, '_inv_Gsqr'):
+            G    = self.gvectors_cart
+            Gsqr = np.einsum('ij,ij->i', G, G)
+            self._inv_Gsqr = np.zeros_like(Gsqr)
+            # First G is 0, can be filtered out
+            self._inv_Gsqr[1:] = 1.0 / Gsqr[1:]
+        return self._inv_Gsqr
+
+    @property
+    def inv_Gsqr_half(self):
+        '''
+        1 / |G|^2 on the non-negative half of the last axis, i.e. the G-vectors
+        of a real-to-complex FFT. Each of these G also stands for -G, hence a
+        weight of 2 except on the planes that contain both G and -G.
+        '''
+        if not hasattr(self, '_inv_Gsqr_half'):
+            nz = self._ngrid[2]
+            w  = np.full(nz // 2 + 1, 2.0)
+            w[0] = 1.0
+            if nz % 2 == 0:
+                w[-1] = 1.0
+            self._inv_Gsqr_half = (
+                    self.inv_Gsqr.reshape(self._ngrid)[..., :nz // 2 + 1] * w
+                    ).flatten()
+        return self._inv_Gsqr_half
+
     def coulomb_integral(self, m: int, n: int, p: int, q: int):
         '''
                   ⌠                 *      1   *
@@ -73,16 +160,59 @@ class PWCoulombIntegral(vaspwfc):
         @out:
             - Coulomb Integral, in eV
         '''
-        rhomn = self.density_matrix(m, n).flatten().conj()
-        rhopq = self.density_matrix(p, q).flatten()
-        Gsqr  = np.linalg.norm(self.gvectors_cart, axis=-1) ** 2
+        # np.vdot conjugates ρₘₙ on the fly, ravel() of the FFT output is a view
+        if self._lgam:
+            # real wavefunctions, ρ(-G) = ρ(G)^*, only half of the G are needed
+            rhomn = self.density_matrix(m, n, half=True)
+            rhopq = self.density_matrix(p, q, half=True)
+            integral = np.vdot(rhomn, rhopq.ravel() * self.inv_Gsqr_half).real
+        else:
+            rhomn = self.density_matrix(m, n)
+            rhopq = self.density_matrix(p, q)
+            integral = np.vdot(rhomn, rhopq.ravel() * self.inv_Gsqr)
 
-        # First G is 0, can be filtered out
         # Here EDEPS / self._Omega / TPI**2 is copied from  pot.F subroutine POTHAR
         # which transforms the  unit to  eV
-        integral = np.sum(rhomn[1:] * rhopq[1:] / Gsqr[1:]) * (EDEPS / self._Omega / TPI**2)
+        integral *= EDEPS / self._Omega / TPI**2
         return integral
 
+    def coulomb_matrix(self, bands):
+        '''
+        (mn|pq) for all the m, n, p, q in "bands". Each ρₘₙ is only
+        transformed once and the integrals are one matrix product over G
+
+            K[mn, pq] = Σ_G ρₘₙ(G)^* ρₚq(G) / |G|²
+
+        @in:
+            - bands: index of states at Gamma point
+        @out:
+            - Coulomb Integrals of shape (nb, nb, nb, nb), in eV
+        '''
+        nb = len(bands)
+        inv_Gsqr = self.inv_Gsqr_half if self._lgam else self.inv_Gsqr
+        rho = np.empty((nb, nb, inv_Gsqr.size), dtype=complex)
+        # ρₙₘ(r) = ρₘₙ(r)^*, i.e. ρₙₘ(G) = ρₘₙ(-G)^*, only m <= n are transformed
+        for ii in range(nb):
+            for jj in range(ii, nb):
+                rhomn = self.density_matrix(bands[ii], bands[jj], half=self._lgam)
+                rho[ii, jj] = rhomn.ravel()
+                if jj == ii:
+                    continue
+                if self._lgam:
+                    # ρₘₙ(r) is real, hence symmetric in m and n
+                    rho[jj, ii] = rho[ii, jj]
+                else:
+                    # G -> -G on the FFT grid
+                    rho[jj, ii] = np.roll(rhomn[::-1, ::-1, ::-1], 1,
+                                          axis=(0, 1, 2)).conj().ravel()
+        rho = rho.reshape((nb * nb, -1))
+
+        K = (rho.conj() * inv_Gsqr) @ rho.T
+        if self._lgam:
+            K = K.real
+        K *= EDEPS / self._Omega / TPI**2
+        return K.reshape((nb, nb, nb, nb))
+
 
 class CoulombIntegral(object):
     '''
@@ -90,38 +220,86 @@ class CoulombIntegral(object):
     def __init__(self, poscar="POSCAR", wavecar="WAVECAR", potcar="POTCAR"):
         self.pwci   = PWCoulombIntegral(fnm=wavecar)
         self.atoms  = read_vasp(poscar)
-        self.pawcorr = [PAWCoulombCorrection(pawpotcar(potstr=potstr))
-                        for potstr in open(potcar).read().split('End of Dataset')[:-1]]
+        # parse the POTCAR once, the projectors reuse the same datasets
+        self.pawpp  = [pawpotcar(potstr=potstr)
+                       for potstr in open(potcar).read().split('End of Dataset')[:-1]]
+        self.pawcorr = [PAWCoulombCorrection(pp) for pp in self.pawpp]
         self.M_pp = [pp.get_coulomb_corrections()[1] for pp in self.pawcorr]
-        self.qproj  = nonlq(self.atoms, self.pwci._encut, potcar)
+        self.qproj  = nonlq(self.atoms, self.pwci._encut, self.pawpp)
 
         atom_cnts   = [int(x) for x in open(poscar).readlines()[6].split()]
         self.element_idx = [idx for (i,cnt) in enumerate(atom_cnts)
                                 for idx in [i]*cnt]
+        # atoms of each element, they share the same M_pp
+        self.element_atoms = [[ia for (ia, ie) in enumerate(self.element_idx) if ie == ip]
+                              for ip in range(len(atom_cnts))]
 
         # self.coul_corr = block_diag(*[self.M_pp[ie] for ie in self.element_idx])
 
-    def coulomb_integral(self, m:int, n:int, p:int, q:int):
-        ci_paw = 0.0
-        for (ia,ip) in enumerate(self.element_idx):
-            beta_njk = [None, None, None, None]
+        # projections <p | psi> of each band on all the atoms
+        self._beta = {}
+
+    def projections(self, iband: int):
+        '''
+        Projections <p | psi> of the state "iband" on the projectors of each
+        atom, grouped by element: one array of shape (natoms, nproj) for each
+        element. The plane-wave coefficients are only read and projected once
+        for each band.
+        '''
+        if iband not in self._beta:
+            Cg = self.pwci.readBandCoeff(ispin=1, ikpt=1, iband=iband, norm=False)
+            self._beta[iband] = [np.array([self.qproj.proj(Cg, whichatom=ia)
+                                           for ia in atoms])
+                                 for atoms in self.element_atoms]
+        return self._beta[iband]
 
-            # calculate projection <p | psi>
-            for (ibeta, iband) in enumerate([m, n, p, q]):
-                Cg = self.pwci.readBandCoeff(ispin=1, ikpt=1, iband=iband, norm=False)
-                beta_njk[ibeta] = self.qproj.proj(Cg, whichatom=ia)
-                pass
-            pass
+    def precompute_projections(self, bands):
+        '''
+        Calculate the projections of all the states in "bands" in advance, e.g.
+        before evaluating many (mn|pq) among them.
+        '''
+        for iband in bands:
+            self.projections(iband)
+
+    def coulomb_integral(self, m:int, n:int, p:int, q:int):
+        # calculate projection <p | psi>
+        beta_njk = [self.projections(iband) for iband in [m, n, p, q]]
 
-            Pij = pack(np.outer(beta_njk[0],        beta_njk[1].conj()))
-            Pkl = pack(np.outer(beta_njk[2].conj(), beta_njk[3]       ))
+        # all the atoms of one element are contracted at once
+        ci_paw = 0.0
+        for ip in range(len(self.element_atoms)):
+            b1, b2, b3, b4 = (beta[ip] for beta in beta_njk)
+            Pij = pack(b1[:, :, None]        * b2[:, None, :].conj())
+            Pkl = pack(b3[:, :, None].conj() * b4[:, None, :]       )
 
-            ci_paw += Pij @ self.M_pp[ip] @ Pkl
+            ci_paw += np.einsum('ai,ij,aj->', Pij, self.M_pp[ip], Pkl)
 
         ci_pw = self.pwci.coulomb_integral(m, n, p, q)
         K_mnpq = ci_pw + 2 * ci_paw
         return (K_mnpq, ci_pw, ci_paw)
 
+    def coulomb_matrix(self, bands):
+        '''
+        (mn|pq) for all the m, n, p, q in "bands", see `coulomb_integral`.
+
+        @out:
+            - (K, K_pw, K_paw), each of shape (nb, nb, nb, nb), in eV
+        '''
+        nb = len(bands)
+        beta_njk = [self.projections(iband) for iband in bands]
+
+        # pack(β_p^* ⊗ β_q) is the conjugate of pack(β_p ⊗ β_q^*)
+        K_paw = np.zeros((nb, nb, nb, nb), dtype=complex)
+        for ip in range(len(self.element_atoms)):
+            b = np.array([beta[ip] for beta in beta_njk])
+            P = pack(b[:, None, :, :, None] * b[None, :, :, None, :].conj())
+            K_paw += np.einsum('mnai,ij,pqaj->mnpq',
+                               P, self.M_pp[ip], P.conj(), optimize=True)
+
+        K_pw = self.pwci.coulomb_matrix(bands)
+        K = K_pw + 2 * K_paw
+        return (K, K_pw, K_paw)
+
     pass
 
 
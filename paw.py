@@ -324,18 +324,20 @@ class pawpotcar(object):
         \int dr = \sum_i w(i) * f(i)
         '''
 
-        self.rad_simp_w = np.zeros_like(self.rgrid)
         # Number of points in the radial grid
         N = self.rgrid.size
         # Logarithmic grid: R(i+1) / R(i) = exp(H)
         # Logarithmic grid: R(i) = R(0) * exp(H*i)
         H = np.log((self.rgrid[-1] / self.rgrid[0])**(1. / (N-1)))
 
-        for ii in range(N-1, 1, -2):
-            self.rad_simp_w[ii] = H * self.rgrid[ii] / \
-                3. + self.rad_simp_w[ii]
-            self.rad_simp_w[ii-1] = H * self.rgrid[ii-1] * 4. / 3.
-            self.rad_simp_w[ii-2] = H * self.rgrid[ii-2] / 3.
+        # Simpson coefficients 1, 4, 2, 4, ..., 2, 4, 1 over the panels
+        # [ii-2, ii] counted backwards from the last grid point
+        ii = np.arange(N-1, 1, -2)
+        c = np.zeros(N)
+        c[ii]   += 1. / 3.
+        c[ii-1]  = 4. / 3.
+        c[ii-2] += 1. / 3.
+        self.rad_simp_w = H * self.rgrid * c
 
     def radial_simp_int(self, f, inside_rcomp=False):
         '''
@@ -351,6 +353,16 @@ class pawpotcar(object):
         else:
             return np.sum(self.rad_simp_w * f)
 
+    def radial_simp_int_nn(self, f, g):
+        '''
+        Simpson integrals of all the products f[n1] * g[n2] on the logarithmic
+        radial grid, as one matrix product with the Simpson weights.
+        '''
+        if not hasattr(self, "rad_simp_w"):
+            self.set_simpi_weight()
+
+        return (np.asarray(f) * self.rad_simp_w) @ np.asarray(g).T
+
     def get_nablaij(self, lreal: bool=True, lforce: bool=False, kmax=200):
         '''
         Calculate the quantity
@@ -486,6 +498,9 @@ class pawpotcar(object):
             from pysbt import GauntTable
             rr = self.rgrid
             self.paw_rij = np.zeros((3, self.lmmax, self.lmmax))
+            # Radial integrals of r_{ij}, rr**2 included in the simp_int
+            R_nn = self.radial_simp_int_nn(self.paw_ae_wfc * rr, self.paw_ae_wfc) - \
+                   self.radial_simp_int_nn(self.paw_ps_wfc * rr, self.paw_ps_wfc)
 
             for ii in range(self.lmmax):
                 for jj in range(self.lmmax):
@@ -500,18 +515,7 @@ class pawpotcar(object):
                     if np.allclose(A, 0):
                         continue
 
-                    # Radial integrals of r_{ij}
-                    # rr**2 included in the simp_int
-                    R_ae = self.radial_simp_int(
-                        self.paw_ae_wfc[n1] * self.paw_ae_wfc[n2] * rr
-                    )
-                    R_ps = self.radial_simp_int(
-                        self.paw_ps_wfc[n1] * self.paw_ps_wfc[n2] * rr
-                    )
-
-                    R = R_ae - R_ps
-
-                    self.paw_rij[:, ii, jj] = R * A
+                    self.paw_rij[:, ii, jj] = R_nn[n1, n2] * A
 
         return self.paw_rij
 
@@ -544,19 +548,13 @@ class pawpotcar(object):
         '''
 
         if not hasattr(self, 'paw_qij'):
-            self.paw_qij = np.zeros((self.lmmax, self.lmmax))
-            for ii in range(self.lmmax):
-                for jj in range(ii+1):
-                    n1, l1, m1 = self.ilm[ii]
-                    n2, l2, m2 = self.ilm[jj]
-                    if (l1 == l2) and (m1 == m2):
-                        self.paw_qij[ii,jj] = self.radial_simp_int(
-                            self.paw_ae_wfc[n1] * self.paw_ae_wfc[n2]
-                            -
-                            self.paw_ps_wfc[n1] * self.paw_ps_wfc[n2]
-                        )
+            # radial integrals of all the (n1, n2) channel pairs at once
+            Q_nn = self.radial_simp_int_nn(self.paw_ae_wfc, self.paw_ae_wfc) - \
+                   self.radial_simp_int_nn(self.paw_ps_wfc, self.paw_ps_wfc)
 
-                        self.paw_qij[jj,ii] = self.paw_qij[ii,jj]
+            n, l, m = np.array(self.ilm).T
+            same_lm = (l[:, None] == l[None, :]) & (m[:, None] == m[None, :])
+            self.paw_qij = np.where(same_lm, Q_nn[n[:, None], n[None, :]], 0.0)
 
         return self.paw_qij
 
@@ -104,6 +104,7 @@ class vaspwfc(object):
 
         # It seems that some modules in scipy uses OPENMP, it is therefore
         # desirable to set the OMP_NUM_THREADS to tune the parallization.
+        self._omp_num_threads = omp_num_threads
         os.environ['OMP_NUM_THREADS'] = str(omp_num_threads)
 
         assert not (lsorbit and lgamma), 'The two settings conflict!'
@@ -129,7 +130,8 @@ class vaspwfc(object):
         '''
         assert 1 <= nproc <= cpu_count()
 
-        os.envrion['OMP_NUM_THREADS'] = str(nproc)
+        self._omp_num_threads = nproc
+        os.environ['OMP_NUM_THREADS'] = str(nproc)
 
     def isSocWfc(self):
         """